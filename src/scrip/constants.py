@@ -1,6 +1,7 @@
 """Constants used for scrip file format."""
 
 # --- Constants for Delimiters ---
+DELIMITER_PREFIX = "--- "  # Shared by every delimiter line below
 BEGIN_FILE_PREFIX = "--- BEGIN FILE: "
 BEGIN_FILE_SUFFIX = " ---"
 END_FILE_PREFIX = "--- END FILE: "
@@ -8,3 +9,4 @@ END_FILE_SUFFIX = " ---"
 EMPTY_DIR_PREFIX = "--- EMPTY DIR: "
 EMPTY_DIR_SUFFIX = " ---"
 BINARY_MARKER = " (BINARY - BASE64 ENCODED)"
+TRAILING_NEWLINE_MARKER = " (ENDS WITH NEWLINE)"  # On END FILE lines of text files ending in a newline
@@ -8,7 +8,7 @@ from .constants import (
     BEGIN_FILE_PREFIX, BEGIN_FILE_SUFFIX,
     END_FILE_PREFIX, END_FILE_SUFFIX,
     EMPTY_DIR_PREFIX, EMPTY_DIR_SUFFIX,
-    BINARY_MARKER
+    BINARY_MARKER, TRAILING_NEWLINE_MARKER, DELIMITER_PREFIX
 )
 from .file_utils import is_binary
 from .flattener import flatten_directory, ScripFlattener
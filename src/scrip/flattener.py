@@ -1,23 +1,55 @@
 """Directory flattening functionality for scrip."""
 
-import base64
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import attrgetter
 from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Tuple
 
 from .constants import (
     BEGIN_FILE_PREFIX, BEGIN_FILE_SUFFIX,
     END_FILE_PREFIX, END_FILE_SUFFIX,
     EMPTY_DIR_PREFIX, EMPTY_DIR_SUFFIX,
-    BINARY_MARKER
+    BINARY_MARKER, TRAILING_NEWLINE_MARKER
 )
-from .file_utils import is_binary
+from .file_utils import (
+    BINARY_PROBE_SIZE, IO_BUFFER_SIZE, advise_sequential, b64encode, default_max_workers, is_binary_chunk
+)
+
+# Read size for streaming base64 encoding; a multiple of 3 so chunks encode without padding.
+# Large enough that per-chunk read/encode/write overhead is negligible.
+BINARY_CHUNK_SIZE = 3 << 20
+
+# Files up to this size are read whole on a worker thread; larger ones are streamed.
+PARALLEL_FILE_LIMIT = 8 << 20
+
+# Total size of the files read by workers but not yet written out. Bounds memory by bytes
+# rather than by entries, however many workers there are.
+MAX_BYTES_IN_FLIGHT = 64 << 20
+
+# Delimiters pre-encoded for the binary-mode output file
+_BEGIN_PREFIX = BEGIN_FILE_PREFIX.encode('utf-8')
+_BEGIN_SUFFIX = BEGIN_FILE_SUFFIX.encode('utf-8') + b'\n'
+_END_PREFIX = END_FILE_PREFIX.encode('utf-8')
+_END_SUFFIX = END_FILE_SUFFIX.encode('utf-8') + b'\n'
+_EMPTY_DIR_PREFIX = EMPTY_DIR_PREFIX.encode('utf-8')
+_EMPTY_DIR_SUFFIX = EMPTY_DIR_SUFFIX.encode('utf-8') + b'\n'
+_BINARY_MARKER = BINARY_MARKER.encode('utf-8')
+_TRAILING_NEWLINE_MARKER = TRAILING_NEWLINE_MARKER.encode('utf-8')
 
 
 class ScripFlattener:
     """Class for flattening directories into scrip format files."""
     
-    def __init__(self):
-        """Initialize the flattener."""
-        pass
+    def __init__(self, max_workers: Optional[int] = None):
+        """Initialize the flattener.
+
+        Files are read and encoded on a pool of ``max_workers`` threads
+        (defaults to the CPU count plus 4, at most 32, as ThreadPoolExecutor
+        does); output order is unaffected.
+        """
+        self.max_workers = max_workers or default_max_workers()
     
     def flatten(self, directory_path: str, output_file: str):
         """Flattens the directory structure into a single text file."""
@@ -25,61 +57,176 @@ class ScripFlattener:
         if not root_path.is_dir():
             raise ValueError(f"Error: {directory_path} is not a valid directory.")
 
-        with open(output_file, 'w', encoding='utf-8') as outfile:
+        # Written in binary mode: delimiters are pre-encoded and content is already bytes
+        with open(output_file, 'wb', buffering=IO_BUFFER_SIZE) as outfile:
             self._process_directory(root_path, outfile)
             
         print(f"Successfully flattened '{directory_path}' to '{output_file}'")
     
     def _process_directory(self, root_path: Path, outfile):
-        """Process all files and directories within the given root."""
-        for item in sorted(root_path.rglob('*')):
-            relative_path = item.relative_to(root_path)
-            
-            if item.is_dir():
-                self._process_empty_directory(item, relative_path, outfile)
-            elif item.is_file():
-                self._process_file(item, relative_path, outfile)
+        """Process all files and directories within the given root.
+
+        Files are read and encoded by worker threads (reads and pybase64 release
+        the GIL) while results are written strictly in walk order. Only a bounded
+        window of entries, holding at most MAX_BYTES_IN_FLIGHT of file content
+        (plus the base64 of binary files), is in flight at once.
+        """
+        window = self.max_workers * 4
+        # (file path, relative path, future, bytes it holds) of each entry not yet written
+        pending: Deque[Tuple[Optional[str], str, Optional[Future], int]] = deque()
+        bytes_in_flight = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for file_path, relative_path, size in self._walk_directory(str(root_path), None):
+                if file_path is None:
+                    pending.append((None, relative_path, None, 0))
+                else:
+                    future = executor.submit(self._render_file, file_path, relative_path)
+                    # Files too large for a worker are streamed later and hold nothing meanwhile
+                    size = size if size <= PARALLEL_FILE_LIMIT else 0
+                    pending.append((file_path, relative_path, future, size))
+                    bytes_in_flight += size
+                while len(pending) >= window or bytes_in_flight > MAX_BYTES_IN_FLIGHT:
+                    bytes_in_flight -= self._write_entry(*pending.popleft(), outfile)
+            while pending:
+                self._write_entry(*pending.popleft(), outfile)
+
+    def _walk_directory(self, dir_path: str, relative_path: Optional[str]) -> Iterator[Tuple[Optional[str], str, int]]:
+        """Recursively walk a directory using a single scandir per directory.
+
+        Yields (file_path, relative_path, size) for files and (None,
+        relative_path, 0) for empty directories. Entries are visited in name order, which matches
+        the order of sorting the full relative paths. ``relative_path`` is None
+        for the root.
+        """
+        with os.scandir(dir_path) as it:
+            entries = sorted(it, key=attrgetter('name'))
+
+        if not entries:
+            if relative_path is not None:
+                yield None, relative_path, 0
+            return
+
+        for entry in entries:
+            # Relative paths are built as plain strings; no Path objects are created per entry
+            entry_relative = entry.name if relative_path is None else relative_path + os.sep + entry.name
+            # DirEntry caches the file type from readdir, so these checks avoid extra stat calls.
+            # Symlinked directories are not descended into.
+            if entry.is_dir(follow_symlinks=False):
+                yield from self._walk_directory(entry.path, entry_relative)
+            elif entry.is_file():
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = 0  # Gone or unreadable; reading it reports the error in its entry
+                yield entry.path, entry_relative, size
+    
+    def _write_entry(self, file_path: Optional[str], relative_path: str, future: Optional[Future],
+                     size: int, outfile) -> int:
+        """Write one walked entry, waiting for its worker result if it is a file.
+
+        Returns ``size``, the bytes in flight the entry no longer holds.
+        """
+        if file_path is None or future is None:  # An empty directory
+            self._process_empty_directory(relative_path, outfile)
+            return size
+        parts = future.result()
+        if parts is None:
+            # Too large to hold in memory; stream it from this thread instead
+            self._process_file(file_path, relative_path, outfile)
+        else:
+            outfile.writelines(parts)
+        return size
     
-    def _process_empty_directory(self, dir_path: Path, relative_path: Path, outfile):
+    def _process_empty_directory(self, relative_path: str, outfile):
         """Process an empty directory."""
-        if not any(dir_path.iterdir()):
-            outfile.write(EMPTY_DIR_PREFIX + str(relative_path) + EMPTY_DIR_SUFFIX + '\n')
+        outfile.write(b''.join((_EMPTY_DIR_PREFIX, os.fsencode(relative_path), _EMPTY_DIR_SUFFIX)))
     
-    def _process_file(self, file_path: Path, relative_path: Path, outfile):
-        """Process a single file."""
-        is_bin = is_binary(file_path)
-        marker = BINARY_MARKER if is_bin else ""
-        
-        # Write begin marker
-        outfile.write(BEGIN_FILE_PREFIX + str(relative_path) + marker + BEGIN_FILE_SUFFIX + '\n')
-        
+    def _render_file(self, file_path: str, relative_path: str) -> Optional[List[bytes]]:
+        """Read and serialise a whole file entry; runs on a worker thread.
+
+        Returns the byte strings making up the entry, or None if the file is
+        larger than PARALLEL_FILE_LIMIT and should be streamed instead.
+        """
+        path = os.fsencode(relative_path)
         try:
-            if is_bin:
-                self._write_binary_file(file_path, outfile)
-            else:
-                self._write_text_file(file_path, outfile)
+            with open(file_path, 'rb') as infile:  # Open in binary mode to preserve exact bytes
+                if os.fstat(infile.fileno()).st_size > PARALLEL_FILE_LIMIT:
+                    return None
+                content = infile.read()
         except Exception as e:
             print(f"Warning: Could not read file {file_path}. Skipping. Error: {e}")
-            outfile.write(f"Error reading file content: {e}\n")
-        
-        # Write end marker - always on its own line without extra newlines
-        outfile.write(END_FILE_PREFIX + str(relative_path) + marker + END_FILE_SUFFIX + '\n')
+            return [
+                _BEGIN_PREFIX, path, _BEGIN_SUFFIX,
+                f"Error reading file content: {e}\n".encode('utf-8', errors='replace'),
+                _END_PREFIX, path, _END_SUFFIX,
+            ]
+        if is_binary_chunk(content[:BINARY_PROBE_SIZE]):
+            return [
+                _BEGIN_PREFIX, path, _BINARY_MARKER, _BEGIN_SUFFIX,
+                b64encode(content), b'\n',
+                _END_PREFIX, path, _BINARY_MARKER, _END_SUFFIX,
+            ]
+        return self._text_entry(path, content)
     
-    def _write_binary_file(self, file_path: Path, outfile):
-        """Write binary file content as base64 encoded."""
-        with open(file_path, 'rb') as infile:
-            encoded_content = base64.b64encode(infile.read()).decode('ascii')
-            outfile.write(encoded_content + '\n')  # Add newline after binary content
+    def _text_entry(self, path: bytes, content: bytes) -> List[bytes]:
+        """Serialise a text file entry.
+
+        A newline is added after content that lacks one, so the END marker
+        appears on its own line; otherwise the END marker records that the
+        file's final newline belongs to its content.
+        """
+        if content.endswith(b'\n'):
+            return [
+                _BEGIN_PREFIX, path, _BEGIN_SUFFIX, content,
+                _END_PREFIX, path, _TRAILING_NEWLINE_MARKER, _END_SUFFIX,
+            ]
+        return [
+            _BEGIN_PREFIX, path, _BEGIN_SUFFIX, content, b'\n',
+            _END_PREFIX, path, _END_SUFFIX,
+        ]
     
-    def _write_text_file(self, file_path: Path, outfile):
-        """Write text file content, preserving exact content."""
-        with open(file_path, 'rb') as infile:  # Open in binary mode to preserve exact bytes
-            content = infile.read()
-            outfile.write(content.decode('utf-8', errors='ignore'))
-            # Always ensure a newline after content, so END marker appears on a new line
-            if not content.endswith(b'\n'):
-                outfile.write('\n')
+    def _process_file(self, file_path: str, relative_path: str, outfile):
+        """Process a single file, streaming binary content in chunks.
 
+        The file is opened once: its leading bytes decide whether it is binary
+        and are then reused as the start of the content.
+        """
+        path = os.fsencode(relative_path)
+        marker = None
+        try:
+            with open(file_path, 'rb') as infile:  # Open in binary mode to preserve exact bytes
+                advise_sequential(infile.fileno())  # Only large files take this path
+                head = infile.read(BINARY_PROBE_SIZE)
+                if is_binary_chunk(head):
+                    marker = _BINARY_MARKER
+                    outfile.write(b''.join((_BEGIN_PREFIX, path, marker, _BEGIN_SUFFIX)))
+                    self._write_binary_file(head, infile, outfile)
+                else:
+                    content = head + infile.read()
+                    marker = b""
+                    # Hand the whole text entry to the buffered writer in a single call
+                    outfile.writelines(self._text_entry(path, content))
+                    return
+        except Exception as e:
+            if marker is None:
+                # The file could not be read, so record it as a text entry
+                marker = b""
+                outfile.write(b''.join((_BEGIN_PREFIX, path, marker, _BEGIN_SUFFIX)))
+            print(f"Warning: Could not read file {file_path}. Skipping. Error: {e}")
+            outfile.write(f"Error reading file content: {e}\n".encode('utf-8', errors='replace'))
+        
+        # Write end marker - always on its own line without extra newlines
+        outfile.write(b''.join((_END_PREFIX, path, marker, _END_SUFFIX)))
+    
+    def _write_binary_file(self, head: bytes, infile, outfile):
+        """Write binary file content as a single base64 encoded line, streamed in chunks."""
+        # Top up the probed bytes to a full chunk (or at least a multiple of 3) so no
+        # padding appears mid-stream
+        chunk = head + infile.read(max(BINARY_CHUNK_SIZE - len(head), -len(head) % 3))
+        while chunk:
+            outfile.write(b64encode(chunk))
+            chunk = infile.read(BINARY_CHUNK_SIZE)
+        outfile.write(b'\n')  # Add newline after binary content
 
 def flatten_directory(directory_path: str, output_file: str):
     """Flattens the directory structure into a single text file.
@@ -1,45 +1,91 @@
 """Parser utilities for scrip file format."""
 
-from typing import Tuple, Optional
+import re
+from typing import Iterator, Tuple, Optional
 from .constants import (
     BEGIN_FILE_PREFIX, BEGIN_FILE_SUFFIX,
     END_FILE_PREFIX, END_FILE_SUFFIX,
     EMPTY_DIR_PREFIX, EMPTY_DIR_SUFFIX,
-    BINARY_MARKER
+    BINARY_MARKER, TRAILING_NEWLINE_MARKER, DELIMITER_PREFIX
 )
 
+# Short tags distinguishing the delimiter types: the two characters after DELIMITER_PREFIX
+_KIND_START = len(DELIMITER_PREFIX)
+BEGIN_FILE_KIND = BEGIN_FILE_PREFIX[_KIND_START:_KIND_START + 2]
+END_FILE_KIND = END_FILE_PREFIX[_KIND_START:_KIND_START + 2]
+EMPTY_DIR_KIND = EMPTY_DIR_PREFIX[_KIND_START:_KIND_START + 2]
+
+# Matches every BEGIN FILE and EMPTY DIR line in raw scrip bytes, capturing the path
+_TARGET_PATH_RE = re.compile(
+    b'^(?:' + re.escape(BEGIN_FILE_PREFIX.encode()) + b'(.*?)(?:' + re.escape(BINARY_MARKER.encode()) + b')?'
+    + re.escape(BEGIN_FILE_SUFFIX.encode())
+    + b'|' + re.escape(EMPTY_DIR_PREFIX.encode()) + b'(.*)' + re.escape(EMPTY_DIR_SUFFIX.encode())
+    + b')\r?$',
+    re.MULTILINE,
+)
+
+# Every delimiter line in one pattern; the named group that matched gives the kind
+_DELIMITER_RE = re.compile(
+    '(?:' + re.escape(BEGIN_FILE_PREFIX) + '(?P<begin>.*?)(?P<begin_bin>' + re.escape(BINARY_MARKER) + ')?'
+    + re.escape(BEGIN_FILE_SUFFIX)
+    + '|' + re.escape(END_FILE_PREFIX) + '(?P<end>.*?)(?P<end_bin>' + re.escape(BINARY_MARKER) + ')?'
+    + '(?P<end_nl>' + re.escape(TRAILING_NEWLINE_MARKER) + ')?' + re.escape(END_FILE_SUFFIX)
+    + '|' + re.escape(EMPTY_DIR_PREFIX) + '(?P<empty>.*)' + re.escape(EMPTY_DIR_SUFFIX)
+    + ')',
+    re.DOTALL,
+)
+
+
+def parse_delimiter_line(line: str) -> Tuple[Optional[str], Optional[str], bool, bool]:
+    """Parses any delimiter line with a single regex match.
+
+    Returns (kind, path_str, is_binary, has_trailing_newline), where kind is
+    one of the *_KIND values, or (None, None, False, False) if the line is not
+    a delimiter. has_trailing_newline is only ever set on END FILE lines.
+    """
+    match = _DELIMITER_RE.fullmatch(line)
+    if match is None:
+        return None, None, False, False
+    path_str = match.group('begin')
+    if path_str is not None:
+        return BEGIN_FILE_KIND, path_str, match.group('begin_bin') is not None, False
+    path_str = match.group('end')
+    if path_str is not None:
+        return (
+            END_FILE_KIND, path_str, match.group('end_bin') is not None,
+            match.group('end_nl') is not None,
+        )
+    return EMPTY_DIR_KIND, match.group('empty'), False, False
+
 
 def parse_begin_file_line(line: str) -> Tuple[Optional[str], bool]:
     """Parses a BEGIN FILE line. Returns (path_str, is_binary) or (None, False)."""
-    if line.startswith(BEGIN_FILE_PREFIX) and line.endswith(BEGIN_FILE_SUFFIX):
-        path_part = line[len(BEGIN_FILE_PREFIX):-len(BEGIN_FILE_SUFFIX)]
-        is_binary = path_part.endswith(BINARY_MARKER)
-        if is_binary:
-            path_str = path_part[:-len(BINARY_MARKER)]
-            return path_str, True
-        else:
-            path_str = path_part
-            return path_str, False
+    kind, path_str, is_binary, _ = parse_delimiter_line(line)
+    if kind == BEGIN_FILE_KIND:
+        return path_str, is_binary
     return None, False
 
 
 def parse_empty_dir_line(line: str) -> Optional[str]:
     """Parses an EMPTY DIR line. Returns path_str or None."""
-    if line.startswith(EMPTY_DIR_PREFIX) and line.endswith(EMPTY_DIR_SUFFIX):
-        path_str = line[len(EMPTY_DIR_PREFIX):-len(EMPTY_DIR_SUFFIX)]
-        return path_str
-    return None
+    kind, path_str, _, _ = parse_delimiter_line(line)
+    return path_str if kind == EMPTY_DIR_KIND else None
 
 
 def parse_end_file_line(line: str) -> Tuple[Optional[str], bool]:
     """Parses an END FILE line. Returns (path_str, is_binary) or (None, False)."""
-    if line.startswith(END_FILE_PREFIX) and line.endswith(END_FILE_SUFFIX):
-        path_part = line[len(END_FILE_PREFIX):-len(END_FILE_SUFFIX)]
-        is_binary = path_part.endswith(BINARY_MARKER)
-        if is_binary:
-            path_str = path_part[:-len(BINARY_MARKER)]
-            return path_str, True
-        else:
-            path_str = path_part
-            return path_str, False
+    kind, path_str, is_binary, _ = parse_delimiter_line(line)
+    if kind == END_FILE_KIND:
+        return path_str, is_binary
     return None, False
+
+
+def iter_target_paths(data) -> Iterator[str]:
+    """Yields the path of every BEGIN FILE and EMPTY DIR line in raw scrip data.
+
+    ``data`` may be any bytes-like object (e.g. an mmap), and is scanned in a
+    single regex pass without splitting or decoding the content lines.
+    """
+    for match in _TARGET_PATH_RE.finditer(data):
+        path_bytes = match.group(1) if match.group(1) is not None else match.group(2)
+        yield path_bytes.decode('utf-8', errors='surrogateescape')
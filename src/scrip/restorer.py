@@ -1,230 +1,488 @@
 """Directory restoration functionality for scrip."""
 
-import base64
-from pathlib import Path
+import binascii
+import mmap
+import os
+import stat
+import unicodedata
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, List, Optional, Protocol, Set, Tuple, Union
 
-from .parser import parse_begin_file_line, parse_empty_dir_line, parse_end_file_line
+from .file_utils import DirectFileWriter, advise_sequential, b64decode_line, default_max_workers
+from .constants import DELIMITER_PREFIX, TRAILING_NEWLINE_MARKER
+from .parser import BEGIN_FILE_KIND, END_FILE_KIND, EMPTY_DIR_KIND, iter_target_paths, parse_delimiter_line
+
+# Buffered content of a file is flushed once it grows past this many bytes
+FLUSH_THRESHOLD = 4 << 20
+
+# Base64 is decoded in slices of at most this many bytes; a multiple of 4
+BINARY_DECODE_CHUNK = 4 << 20
+
+# With direct I/O enabled, binary entries with at least this much base64 bypass the page cache
+DIRECT_IO_MIN_SIZE = 64 << 20
+
+_DELIMITER_PREFIX = DELIMITER_PREFIX.encode('utf-8')
+
+# Removed from base64 before decoding, so slices split on whole quanta and every decoder
+# backend sees the same input
+_BASE64_WHITESPACE = b' \t\r\n'
+
+# Every delimiter continues its prefix with one of these tags, so lines that only share
+# the prefix (diff headers, Markdown rules) are recognised as content without decoding
+_KIND_TAGS = frozenset(kind.encode('utf-8') for kind in (BEGIN_FILE_KIND, END_FILE_KIND, EMPTY_DIR_KIND))
+_KIND_TAG_END = len(_DELIMITER_PREFIX) + 2
+
+
+class _OutputFile(Protocol):
+    """A file being restored: a regular binary file or a DirectFileWriter."""
+
+    def write(self, data: Union[bytes, memoryview]) -> int: ...
+
+    def writelines(self, lines: Iterable[bytes]) -> None: ...
+
+    def close(self) -> None: ...
+
+
+def _fold_name(name: str) -> str:
+    """Normalise a file name for comparisons that ignore case and Unicode form."""
+    return unicodedata.normalize('NFC', name).casefold()
 
 
 class ScripRestorer:
     """Class for restoring directories from scrip format files."""
     
-    def __init__(self):
-        """Initialize the restorer."""
-        pass
+    def __init__(self, direct_io: bool = False, max_workers: Optional[int] = None):
+        """Initialize the restorer.
+
+        Text files are written on a pool of ``max_workers`` threads (defaults
+        to the CPU count plus 4, at most 32, as for the flattener). With
+        ``direct_io``, large binary files are written with O_DIRECT where the
+        platform and file system support it, so that restoring them does not
+        evict other data from the page cache.
+        """
+        self.direct_io = direct_io
+        self.max_workers = max_workers or default_max_workers()
+        self._created_dirs: Set[str] = set()  # Directories known to exist during the current restore
     
-    def restore(self, input_file: str, output_directory: str):
+    def restore(self, input_file: str, output_directory: str) -> None:
         """Restores the directory structure from a scrip file."""
-        input_path = Path(input_file).resolve()
-        output_root = Path(output_directory).resolve()
+        # Paths are made absolute with string operations only, and the input is
+        # checked with a single stat call
+        input_path = os.path.abspath(input_file)
+        output_root = os.path.abspath(output_directory)
 
-        if not input_path.is_file():
+        try:
+            is_file = stat.S_ISREG(os.stat(input_path).st_mode)
+        except (OSError, ValueError):
+            is_file = False
+        if not is_file:
             raise ValueError(f"Error: {input_file} is not a valid file.")
 
-        # First check for conflicts
-        conflicts = self._check_conflicts(input_path, output_root)
-        if conflicts:
-            self._handle_conflicts(conflicts, output_root)
+        # First check for conflicts. Nothing can conflict in a missing or empty
+        # output directory, so the common case restores in a single pass.
+        if not self._is_missing_or_empty(output_root):
+            conflicts = self._check_conflicts(input_path, output_root)
+            if conflicts:
+                self._handle_conflicts(conflicts, output_root)
             
         # Then perform the actual restoration
         self._perform_restoration(input_path, output_root)
             
-        print(f"Successfully restored '{input_path.name}' to '{output_directory}'")
+        print(f"Successfully restored '{os.path.basename(input_path)}' to '{output_directory}'")
+    
+    def _is_missing_or_empty(self, directory: str) -> bool:
+        """Check whether a directory does not exist yet or has no entries."""
+        try:
+            with os.scandir(directory) as it:
+                return next(it, None) is None
+        except FileNotFoundError:
+            return True
+        except NotADirectoryError:
+            return False  # Let the restore fail as before
     
-    def _check_conflicts(self, input_path: Path, output_root: Path):
+    def _check_conflicts(self, input_path: str, output_root: str) -> List[str]:
         """Check for any conflicts with existing files or directories."""
-        conflicts = []
+        conflicts: List[str] = []
+        listings: Dict[str, Tuple[Set[str], Set[str]]] = {}  # Parent directory -> its entry names, from one scandir each
         
         try:
-            with open(input_path, 'r', encoding='utf-8') as infile:
-                for line in infile:
-                    line_rstrip = line.rstrip('\n')
-
-                    path_str, _ = parse_begin_file_line(line_rstrip)
-                    if path_str is not None:
-                        target_path = output_root / path_str
-                        if target_path.exists():
+            with open(input_path, 'rb') as infile:
+                if os.fstat(infile.fileno()).st_size == 0:
+                    return conflicts  # mmap cannot map an empty file
+                # Scan the mapped file once for target paths instead of decoding every line
+                with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for path_str in iter_target_paths(data):
+                        target_path = os.path.join(output_root, path_str)
+                        if self._path_exists(target_path, listings):
                             conflicts.append(target_path)
-                        continue  # Move to next line
-
-                    path_str = parse_empty_dir_line(line_rstrip)
-                    if path_str is not None:
-                        target_path = output_root / path_str
-                        if target_path.exists():
-                            conflicts.append(target_path)
-                        continue  # Move to next line
         except Exception as e:
             raise IOError(f"Error reading or parsing input file {input_path}: {e}") from e
             
         return conflicts
     
-    def _handle_conflicts(self, conflicts, output_root: Path):
+    def _path_exists(self, path: str, listings: Dict[str, Tuple[Set[str], Set[str]]]) -> bool:
+        """Check whether a path exists using a cached listing of its parent directory.
+
+        Each parent is listed once with os.scandir, replacing a stat call per
+        target. A name matching only case- or normalisation-insensitively is
+        confirmed with a real exists() check, for file systems that fold names.
+        """
+        parent, name = os.path.split(path)
+        listing = listings.get(parent)
+        if listing is None:
+            listing = listings[parent] = self._list_directory(parent)
+        names, folded_names = listing
+        if name in names:
+            return True
+        return _fold_name(name) in folded_names and os.path.exists(path)
+    
+    def _list_directory(self, directory: str) -> Tuple[Set[str], Set[str]]:
+        """Returns (names, folded names) of a directory's entries; empty if it is not a directory."""
+        try:
+            with os.scandir(directory) as it:
+                names = {entry.name for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            names = set()
+        return names, {_fold_name(name) for name in names}
+    
+    def _handle_conflicts(self, conflicts: List[str], output_root: str) -> None:
         """Handle any conflicts found during conflict checking."""
-        conflict_list_str = "\n".join([str(p.relative_to(output_root)) for p in conflicts])
+        conflict_list_str = "\n".join([os.path.relpath(p, output_root) for p in conflicts])
         raise FileExistsError(
             f"Error: The following paths already exist in {output_root}. "
             f"Please remove them or choose a different output directory:\n{conflict_list_str}"
         )
     
-    def _perform_restoration(self, input_path: Path, output_root: Path):
+    def _perform_restoration(self, input_path: str, output_root: str) -> None:
         """Perform the actual restoration process."""
-        output_root.mkdir(parents=True, exist_ok=True)  # Create root if needed
+        os.makedirs(output_root, exist_ok=True)  # Create root if needed
+        self._created_dirs = {output_root}
         
         try:
-            with open(input_path, 'r', encoding='utf-8') as infile:
-                self._process_file_contents(infile, output_root)
+            # The input is mapped and split into byte lines in C; content is never decoded
+            with open(input_path, 'rb') as infile:
+                if os.fstat(infile.fileno()).st_size == 0:
+                    return  # mmap cannot map an empty file
+                advise_sequential(infile.fileno())
+                with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        data.madvise(mmap.MADV_SEQUENTIAL)
+                    self._process_file_contents(data, output_root)
         except Exception as e:
             # Consider cleanup of partially created files/dirs?
             raise IOError(f"Error writing files during restoration to {output_root}: {e}") from e
     
-    def _process_file_contents(self, infile, output_root: Path):
-        """Process the contents of the input file."""
-        current_file_handle = None
-        current_file_path = None
+    def _process_file_contents(self, data: mmap.mmap, output_root: str) -> None:
+        """Process the contents of the mapped input file.
+
+        Lines are split with mmap.readline. Text content lines are written out
+        as raw bytes and binary content is decoded straight from the mapping;
+        only delimiter lines are decoded to str for parsing.
+
+        Parsing and directory creation happen on this thread. A text file that
+        fits in the buffer is created, written and closed on a worker thread
+        (file system calls release the GIL) while parsing moves on; larger
+        files and binary files are opened here and written as they stream.
+        """
+        current_file_path = None  # Target of the file being restored, or None between files
+        current_file_handle = None  # Its handle, once opened on this thread
         current_file_is_binary = False
         expected_end_path = None  # Store the path expected by the END marker
-        content_buffer = []  # Buffer for collecting content lines
+        content_buffer: List[bytes] = []  # Buffer for collecting content lines, reused for every file
+        append = content_buffer.append  # Rebound whenever content_buffer is replaced
+        buffered_size = 0  # Bytes currently held in content_buffer
+        empty_dirs: List[str] = []  # Paths of EMPTY DIR markers, created together at the end
+        window = self.max_workers * 4
+        pending: Deque[Tuple[str, Future]] = deque()  # (target path, future) of files being written, in submission order
+        in_flight: Dict[str, Future] = {}  # Target path -> future of its pending write
         
-        for line_num, line in enumerate(infile, 1):
-            line_rstrip = line.rstrip('\n')
-            
-            # Try parsing delimiters first
-            begin_path, is_binary_next = parse_begin_file_line(line_rstrip)
-            if begin_path is not None:
-                # Handle any previously open file
-                if current_file_handle:
-                    self._write_buffered_content(current_file_handle, content_buffer, current_file_is_binary)
-                    current_file_handle.close()
-                
-                # Start a new file
-                current_file_handle = self._handle_begin_file(
-                    begin_path, is_binary_next, None, None, output_root, line_num
-                )
-                current_file_is_binary = is_binary_next
-                current_file_path = output_root / begin_path
-                expected_end_path = begin_path  # Store for matching END marker
-                content_buffer = []  # Clear the buffer
-                continue  # Move to next line
-                
-            empty_dir_path = parse_empty_dir_line(line_rstrip)
-            if empty_dir_path is not None:
-                # Handle any previously open file
-                if current_file_handle:
-                    self._write_buffered_content(current_file_handle, content_buffer, current_file_is_binary)
-                    current_file_handle.close()
-                
-                # Process empty directory
-                self._handle_empty_dir(empty_dir_path, None, None, output_root, line_num)
-                
-                # Reset file state
-                current_file_handle = None
-                current_file_is_binary = False
-                current_file_path = None
-                expected_end_path = None
-                content_buffer = []  # Clear the buffer
-                continue  # Move to next line
-                
-            end_path, end_is_binary = parse_end_file_line(line_rstrip)
-            if end_path is not None:
-                # Handle end of file - write any buffered content
-                if current_file_handle:
-                    self._write_buffered_content(current_file_handle, content_buffer, current_file_is_binary)
+        # Bind names used on every line to locals (LOAD_FAST instead of global/attribute lookups)
+        prefix = _DELIMITER_PREFIX
+        prefix_len = len(prefix)
+        kind_tags = _KIND_TAGS
+        kind_tag_end = _KIND_TAG_END
+        parse_delimiter = parse_delimiter_line
+        finish_file = self._finish_file
+        flush_partial = self._flush_partial_content
+        flush_threshold = FLUSH_THRESHOLD
+        trailing_newline_marker = TRAILING_NEWLINE_MARKER
+        
+        line_num = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                # readline continues from the mapping's position, which binary streaming advances
+                for line in iter(data.readline, b''):
+                    line_num += 1
+                    # Lines without the delimiter prefix and tag are always content, so they
+                    # are dispatched on the current state alone without any parsing
+                    if not line.startswith(prefix) or line[prefix_len:kind_tag_end] not in kind_tags:
+                        if current_file_path is None:
+                            continue  # Idle: only delimiters mean anything, stray content is skipped
+                        # In a file: the hot path taken by the vast majority of lines
+                        append(line)
+                        buffered_size += len(line)
+                        if buffered_size >= flush_threshold:
+                            # Keep memory bounded for large files by writing out what is safe so far
+                            if current_file_handle is None:
+                                current_file_handle = self._open_file(current_file_path, line_num)
+                            flush_partial(current_file_handle, content_buffer, current_file_is_binary)
+                            buffered_size = sum(map(len, content_buffer))
+                        continue
                     
-                    # Close file and verify end marker
-                    self._handle_end_file(
-                        end_path, end_is_binary, current_file_handle, 
-                        current_file_path, expected_end_path, 
-                        current_file_is_binary, line_num
-                    )
-                else:
-                    print(f"Warning (L{line_num}): Found END FILE marker but no file is currently open: {line_rstrip}")
+                    line_rstrip = line.rstrip(b'\r\n').decode('utf-8', errors='surrogateescape')
+                    # Try parsing delimiters first, with a single regex match for all kinds
+                    kind, delimiter_path, delimiter_is_binary, has_trailing_newline = parse_delimiter(line_rstrip)
+                    
+                    if kind is None:
+                        # A content line that merely starts like a delimiter - add to buffer
+                        if current_file_path is not None:
+                            append(line)
+                            buffered_size += len(line)
+                        continue
+                    assert delimiter_path is not None  # Every delimiter kind has a path
+                    
+                    if kind == END_FILE_KIND:
+                        if has_trailing_newline and delimiter_path + trailing_newline_marker == expected_end_path:
+                            # The marker text is the end of the path itself, not a flag
+                            delimiter_path += trailing_newline_marker
+                            has_trailing_newline = False
+                        # Verify the marker against the open file before it is written out
+                        self._handle_end_file(
+                            delimiter_path, delimiter_is_binary, current_file_path,
+                            expected_end_path, current_file_is_binary, line_num
+                        )
+                    else:
+                        # A BEGIN FILE or EMPTY DIR marker implicitly ends any open file
+                        has_trailing_newline = True
+                    if current_file_path is not None:
+                        if current_file_handle is not None:
+                            finish_file(current_file_handle, content_buffer, current_file_is_binary, has_trailing_newline)
+                        else:
+                            if len(pending) >= window:
+                                self._complete_write(pending, in_flight)
+                            future = executor.submit(
+                                self._write_file, current_file_path, content_buffer, has_trailing_newline
+                            )
+                            pending.append((current_file_path, future))
+                            in_flight[current_file_path] = future
+                            content_buffer = []  # Now owned by the worker
+                            append = content_buffer.append
+                    current_file_path = None
+                    current_file_handle = None
+                    buffered_size = 0
+                    
+                    if kind == BEGIN_FILE_KIND:
+                        # Start a new file
+                        current_file_path = self._handle_begin_file(delimiter_path, output_root)
+                        current_file_is_binary = delimiter_is_binary
+                        expected_end_path = delimiter_path  # Store for matching END marker
+                        previous_write = in_flight.get(current_file_path)
+                        if previous_write is not None:
+                            previous_write.result()  # The path is listed twice; the later entry must win
+                        if delimiter_is_binary:
+                            binary_end = self._binary_section_end(data)
+                            direct_io = self.direct_io and binary_end - data.tell() >= DIRECT_IO_MIN_SIZE
+                            current_file_handle = self._open_file(current_file_path, line_num, direct_io)
+                            line_num += self._stream_binary_content(data, current_file_handle, binary_end)
+                    elif kind == EMPTY_DIR_KIND:
+                        empty_dirs.append(delimiter_path)
                 
-                # Reset file state
-                current_file_handle = None
-                current_file_is_binary = False
-                current_file_path = None
-                expected_end_path = None
-                content_buffer = []  # Clear the buffer
-                continue  # Move to next line
+                # End of file processing
+                if current_file_path is not None:
+                    print(f"Warning: Input file ended unexpectedly while processing file {current_file_path}. Closing file.")
+                    if current_file_handle is None:
+                        current_file_handle = self._open_file(current_file_path, line_num)
+                    finish_file(current_file_handle, content_buffer, current_file_is_binary)
+                    current_file_handle = None
                 
-            # Process content line - add to buffer
-            if current_file_handle:
-                content_buffer.append(line)
-        
-        # End of file processing
-        if current_file_handle:
-            # Write any remaining buffered content
-            self._write_buffered_content(current_file_handle, content_buffer, current_file_is_binary)
-            print(f"Warning: Input file ended unexpectedly while processing file {current_file_path}. Closing file.")
-            current_file_handle.close()
+                # Wait for the remaining writes, raising any error they hit
+                while pending:
+                    self._complete_write(pending, in_flight)
+                self._create_empty_dirs(empty_dirs, output_root)
+            finally:
+                if current_file_handle is not None:
+                    current_file_handle.close()  # Restoring failed midway; do not leak the handle
+    
+    def _complete_write(self, pending: Deque[Tuple[str, Future]], in_flight: Dict[str, Future]) -> None:
+        """Wait for the oldest pending file write, raising any error it hit."""
+        target_path, future = pending.popleft()
+        if in_flight.get(target_path) is future:
+            del in_flight[target_path]
+        future.result()
     
-    def _write_buffered_content(self, file_handle, content_buffer, is_binary):
-        """Write buffered content to the file."""
+    def _write_file(self, target_path: str, content_buffer: List[bytes], has_trailing_newline: bool) -> None:
+        """Create a text file with its buffered content; runs on a worker thread."""
+        # The content goes out in a single write, so the default buffer is never filled
+        with open(target_path, 'wb') as file_handle:
+            self._write_buffered_content(file_handle, content_buffer, False, has_trailing_newline)
+    
+    def _finish_file(self, file_handle: _OutputFile, content_buffer: List[bytes], is_binary: bool,
+                     has_trailing_newline: bool = True) -> None:
+        """Write out a file's remaining buffered content, close it and empty the buffer."""
+        self._write_buffered_content(file_handle, content_buffer, is_binary, has_trailing_newline)
+        file_handle.close()
+        content_buffer.clear()  # Reuse the list for the next file rather than allocating a new one
+    
+    def _write_buffered_content(self, file_handle: _OutputFile, content_buffer: List[bytes], is_binary: bool,
+                                has_trailing_newline: bool = True) -> None:
+        """Write buffered content to the file.
+
+        For text, ``has_trailing_newline`` comes from the END FILE marker: when
+        it is False the final newline was added by the flattener and is dropped,
+        unless the content ends in a blank line. Files flattened before the
+        marker existed relied on that rule, and an unmarked entry of the current
+        format never ends in one. Content written without a matching END marker
+        is kept as-is.
+        """
         if not content_buffer:
             return
             
         if is_binary:
             # For binary content, decode the base64 string
             try:
-                # Remove the ending newline that was added during flattening
-                encoded_content = content_buffer[0].rstrip('\n')
-                decoded_bytes = base64.b64decode(encoded_content)
+                # Accept base64 split across any number of lines as well as a single line,
+                # including lines padded with trailing whitespace
+                encoded_content = b''.join(content_buffer).translate(None, _BASE64_WHITESPACE)
+                decoded_bytes = b64decode_line(encoded_content)
                 file_handle.write(decoded_bytes)
-            except base64.binascii.Error as e:
+            except binascii.Error as e:
                 print(f"Warning: Could not decode base64 content. Error: {e}")
         else:
-            # For text content, we need to handle the newline that might have been
-            # added by the flattener to ensure the END marker appears on its own line
-            
-            # Join all the content lines
-            file_content = ''.join(content_buffer)
-            
-            # If content ends with a newline and original content didn't have one,
-            # we need to remove it
-            if file_content.endswith('\n'):
-                # Check if there's a newline after content - this is likely added by flattener
-                # We look at the second-to-last character - if it's also a newline, then the file
-                # probably originally ended with a newline
-                if len(file_content) >= 2 and file_content[-2] == '\n':
-                    # File likely had a trailing newline, keep as is
-                    pass
-                else:
-                    # File likely didn't have a trailing newline, remove the one added by flattener
-                    file_content = file_content[:-1]
-            
-            file_handle.write(file_content)
+            # The lines are joined into one write: handed to the file one by one, each
+            # small line would be copied into its buffer and written every 8 KiB. The
+            # join costs one copy of at most FLUSH_THRESHOLD bytes.
+            content = b''.join(content_buffer)
+            last_line = content_buffer[-1]
+            # Every line before the last ends in a newline, so a lone newline after
+            # one means the content ends in a blank line
+            ends_blank_line = last_line == b'\n' and len(content_buffer) > 1
+            if not (has_trailing_newline or ends_blank_line) and content.endswith(b'\n'):
+                # The newline the flattener added so the END marker starts a new line
+                # is not part of the file
+                file_handle.write(memoryview(content)[:-1])  # Without copying the content again
+                return
+            file_handle.write(content)
     
-    def _handle_begin_file(self, path_str, is_binary, current_handle, current_path, output_root, line_num):
-        """Handle a BEGIN FILE marker."""
-        if current_handle:
-            print(f"Warning (L{line_num}): Found new BEGIN FILE marker before END FILE for {current_path}. Closing previous.")
-            current_handle.close()
-            
-        target_path = output_root / path_str
-        mode = 'wb' if is_binary else 'w'
-        
-        # Ensure parent dir exists
+    def _binary_section_end(self, data: mmap.mmap) -> int:
+        """Returns where a binary entry's base64 lines, starting at the current position, end.
+
+        That is just after the newline preceding the next line starting with
+        the delimiter prefix, or the end of the input.
+        """
+        # The current position is just past the BEGIN FILE line, so never 0
+        end = data.find(b'\n' + _DELIMITER_PREFIX, data.tell() - 1)
+        return len(data) if end < 0 else end + 1
+    
+    def _stream_binary_content(self, data: mmap.mmap, file_handle: _OutputFile, end: int) -> int:
+        """Decode a binary entry's base64 lines directly from the mapped input.
+
+        Consumes lines from the current position up to ``end``, found by
+        _binary_section_end. The section is decoded in slices of
+        BINARY_DECODE_CHUNK regardless of how it is wrapped into lines, so each
+        slice is one large write to the open file, and even a single
+        multi-gigabyte line is never held in memory at once. Characters beyond a
+        whole base64 quantum are carried into the next slice. Returns the
+        number of lines consumed.
+        """
+        start = pos = data.tell()
+        carry = b''
+        lines_consumed = 0
+        while pos < end:
+            slice_end = min(pos + BINARY_DECODE_CHUNK, end)
+            raw = data[pos:slice_end]
+            lines_consumed += raw.count(b'\n')
+            encoded = carry + raw.translate(None, _BASE64_WHITESPACE)
+            split = len(encoded) - len(encoded) % 4
+            if split:
+                self._decode_into(file_handle, encoded[:split])
+            carry = encoded[split:]
+            pos = slice_end
+        if end == len(data) and end > start and data[end - 1:end] != b'\n':
+            lines_consumed += 1  # Unterminated last line of the input
+        if carry:
+            self._decode_into(file_handle, carry)  # Malformed tail; reported by the decoder
+        data.seek(pos)
+        return lines_consumed
+    
+    def _decode_into(self, file_handle: _OutputFile, encoded: bytes) -> None:
+        """Decode a base64 slice and write it, warning instead of failing on bad input."""
         try:
-            target_path.parent.mkdir(parents=True, exist_ok=True)
-            return open(target_path, mode, encoding=(None if is_binary else 'utf-8'))
+            file_handle.write(b64decode_line(encoded))
+        except binascii.Error as e:
+            print(f"Warning: Could not decode base64 content. Error: {e}")
+    
+    def _flush_partial_content(self, file_handle: _OutputFile, content_buffer: List[bytes], is_binary: bool) -> None:
+        """Write out part of a large buffer mid-file, leaving in it what must stay buffered.
+
+        Text keeps its last two lines: the newline of the last may yet be
+        dropped at the END FILE marker, depending on whether it follows a
+        blank line. Binary decodes the longest whole number of base64 quanta
+        and keeps the remaining characters.
+        """
+        if is_binary:
+            encoded_content = b''.join(content_buffer).translate(None, _BASE64_WHITESPACE)
+            split = len(encoded_content) - len(encoded_content) % 4
+            self._write_buffered_content(file_handle, [encoded_content[:split]], True)
+            content_buffer[:] = [encoded_content[split:]]
+            return
+        self._write_buffered_content(file_handle, content_buffer[:-2], False)
+        del content_buffer[:-2]
+    
+    def _handle_begin_file(self, path_str: str, output_root: str) -> str:
+        """Handle a BEGIN FILE marker: create the parent directory and return the target path."""
+        target_path = os.path.join(output_root, path_str)
+        self._ensure_directory(os.path.dirname(target_path))
+        return target_path
+    
+    def _open_file(self, target_path: str, line_num: int, direct_io: bool = False) -> _OutputFile:
+        """Open a file being restored for writing on this thread."""
+        try:
+            if direct_io:
+                try:
+                    return DirectFileWriter(target_path)
+                except OSError:
+                    pass  # Not supported here (e.g. tmpfs); use a regular buffered file
+            # Text content arrives as raw bytes too, so every file is written in binary mode.
+            # Each flush of text and each decoded binary slice is a single large write, which
+            # the buffered writer passes straight to the file. The default buffer therefore
+            # suffices, and a many-small-files restore avoids allocating a big buffer per file.
+            return open(target_path, 'wb')
         except IOError as e:
             print(f"Error (L{line_num}): Could not open file for writing: {target_path}. Error: {e}")
             raise  # Abort on file open error
     
-    def _handle_empty_dir(self, path_str, current_handle, current_path, output_root, line_num):
-        """Handle an EMPTY DIR marker."""
-        if current_handle:
-            print(f"Warning (L{line_num}): Found EMPTY DIR marker while processing file {current_path}. Closing file.")
-            current_handle.close()
-            
-        target_path = output_root / path_str
-        target_path.mkdir(parents=True, exist_ok=True)  # Create the empty directory
-        return None
+    def _create_empty_dirs(self, path_strs: Iterable[str], output_root: str) -> None:
+        """Create the directories of all EMPTY DIR markers.
+
+        Paths are created in reverse sorted order, so a directory comes before
+        any of its ancestors, which are then already known to exist and are
+        skipped without a system call.
+        """
+        for path_str in sorted(set(path_strs), reverse=True):
+            self._ensure_directory(os.path.join(output_root, path_str))
     
-    def _handle_end_file(self, path_str, is_binary, current_handle, current_path, 
-                         expected_path, current_is_binary, line_num):
-        """Handle an END FILE marker."""
-        if current_handle:
+    def _ensure_directory(self, dir_path: str) -> None:
+        """Create a directory and its parents, skipping ones already created in this restore."""
+        created_dirs = self._created_dirs
+        if dir_path in created_dirs:
+            return
+        os.makedirs(dir_path, exist_ok=True)
+        # Record the new directory and its ancestors, stopping at the first one already known
+        while dir_path not in created_dirs:
+            created_dirs.add(dir_path)
+            parent = os.path.dirname(dir_path)
+            if parent == dir_path:
+                break  # Reached the file system root
+            dir_path = parent
+    
+    def _handle_end_file(self, path_str: str, is_binary: bool, current_path: Optional[str],
+                         expected_path: Optional[str], current_is_binary: bool, line_num: int) -> None:
+        """Handle an END FILE marker, warning if it does not match the open file.
+
+        The file itself is written out and closed by the caller.
+        """
+        if current_path is not None:
             # Optional: Verify end marker details match begin marker details
             if path_str != expected_path or is_binary != current_is_binary:
                 print(
@@ -232,39 +490,13 @@ class ScripRestorer:
                     f"Expected path='{expected_path}', binary={current_is_binary}. "
                     f"Got path='{path_str}', binary={is_binary}."
                 )
-            current_handle.close()
             return None
         else:
             print(f"Warning (L{line_num}): Found END FILE marker but no file is currently open: {path_str}")
             return None
-    
-    def _process_content_line(self, line, line_rstrip, file_handle, is_binary, file_path, line_num):
-        """Process a content line (legacy method, no longer used)."""
-        try:
-            if is_binary:
-                # Base64 content line - decode and write
-                decoded_bytes = base64.b64decode(line_rstrip)
-                file_handle.write(decoded_bytes)
-            else:
-                # Text content line - write preserving original line ending
-                file_handle.write(line)
-        except base64.binascii.Error as decode_error:
-            print(
-                f"Warning (L{line_num}): Could not decode base64 content for {file_path}. "
-                f"Line: '{line_rstrip[:50]}...'. Error: {decode_error}"
-            )
-            # Decide: skip line, write placeholder, or raise error? Skipping line for now.
-        except IOError as e:
-            print(f"Error (L{line_num}): Could not write to file {file_path}. Error: {e}")
-            file_handle.close()  # Close on error
-            raise  # Abort on write error
-        except Exception as e:
-            print(f"Error (L{line_num}): Unexpected error writing content for {file_path}. Error: {e}")
-            file_handle.close()
-            raise
 
 
-def restore_directory(input_file: str, output_directory: str):
+def restore_directory(input_file: str, output_directory: str) -> None:
     """Restores the directory structure from a scrip file.
     
     This function maintains backward compatibility with the original API.
@@ -0,0 +1,9 @@
+"""Shared pytest configuration for the scrip tests."""
+
+import os
+import tempfile
+
+# Every test is bound by file I/O on tmp_path, which pytest places under tempfile.gettempdir().
+# Point that at a RAM-backed tmpfs where one is available, unless TMPDIR already chooses a location.
+if "TMPDIR" not in os.environ and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+    tempfile.tempdir = "/dev/shm"
@@ -1,11 +1,20 @@
 """Tests for the core scrip/unscrip logic."""
 
 import pytest
+import contextlib
 import os
+import re
 import shutil
-import base64 # Keep for potential future use, but not used now
+import base64
+import binascii
+from collections import namedtuple
 from pathlib import Path
 from src.scrip import core
+from src.scrip import file_utils, flattener, parser, restorer
+
+# Bound once so test call sites skip the attribute lookup on core
+flatten_directory = core.flatten_directory
+restore_directory = core.restore_directory
 
 # --- Constants for easier assertion ---
 BFP = core.BEGIN_FILE_PREFIX
@@ -15,306 +24,605 @@ EFS = core.END_FILE_SUFFIX
 EDP = core.EMPTY_DIR_PREFIX
 EDS = core.EMPTY_DIR_SUFFIX
 BM = core.BINARY_MARKER
+TNM = core.TRAILING_NEWLINE_MARKER
+
+# Matches the message restore raises when entries would overwrite existing paths
+_CONFLICT_RE = re.compile("already exist")
+
+# The same delimiters encoded once, for comparing against raw scrip bytes
+BFP_B = BFP.encode('utf-8')
+BFS_B = BFS.encode('utf-8')
+EFP_B = EFP.encode('utf-8')
+EFS_B = EFS.encode('utf-8')
+EDP_B = EDP.encode('utf-8')
+EDS_B = EDS.encode('utf-8')
+BM_B = BM.encode('utf-8')
+TNM_B = TNM.encode('utf-8')
+
+# --- Structures shared by the round-trip tests ---
+
+STRUCTURES = {
+    "single_text": {"file1.txt": "Hello\nWorld"},
+    "multiple_text": {
+        "file1.txt": "Content 1", # No trailing newline here
+        "file2.log": "Log line\nAnother log line"
+    },
+    "subdir_file": {"subdir": {"nested.txt": "Nested content."}},
+    "nested": {
+        "file1.txt": "Root file.",
+        "a": {
+            "file_a.txt": "File in A.",
+            "b": {
+                "file_b.txt": "File in B."
+            },
+            "empty_b": None
+        },
+        "empty_root": None
+    },
+}
 
 # --- Helper Functions for Tests ---
 
+def _flatten_structure(base_dir: Path, structure: dict):
+    """Returns the directories and files described by a nested dict structure.
+
+    Directories map their path to whether they should be empty; files are
+    (path, bytes) pairs.
+    """
+    dirs, files = {}, []
+    stack = [(str(base_dir), structure)]
+    while stack:
+        parent, entries = stack.pop()
+        for name, content in entries.items():
+            path = os.path.join(parent, name)
+            if isinstance(content, dict):
+                dirs[path] = False
+                stack.append((path, content))
+            elif content is None: # Represents an empty directory
+                dirs[path] = True
+            else:
+                files.append((path, content.encode('utf-8') if isinstance(content, str) else content))
+    return dirs, files
+
 def create_test_files(base_dir: Path, structure: dict):
-    """Recursively creates files and directories based on a dict structure."""
-    for name, content in structure.items():
-        path = base_dir / name
-        if isinstance(content, dict):
-            path.mkdir()
-            create_test_files(path, content)
-        elif isinstance(content, str):
-            path.write_text(content, encoding='utf-8')
-        elif content is None: # Represents an empty directory
-             path.mkdir()
-        # Add bytes support later if needed
+    """Creates the files and directories of a nested dict structure.
+
+    Strings are written as UTF-8, bytes as they are, and None is an empty directory.
+    """
+    dirs, files = _flatten_structure(base_dir, structure)
+    for dir_path in sorted(dirs, key=lambda path: path.count(os.sep)):  # Parents first
+        os.mkdir(dir_path)
+    for file_path, data in files:
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+def _walk_tree(root: str):
+    """Yields the DirEntry of every file and directory below root, listing each directory once with os.scandir.
+
+    Walks with an explicit stack, so the depth of the tree costs no Python frames.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                yield entry
+
+def _collect_files(root: str) -> list:
+    """Lists every entry below root as a (relative path, is_dir, is_empty) tuple, sorted by path.
+
+    Each entry's type comes from its DirEntry without another stat; a directory
+    is empty when no walked entry lies directly inside it.
+    """
+    entries = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in _walk_tree(root)]
+    parents = {os.path.dirname(path) for path, _ in entries}
+    return sorted(
+        (os.path.relpath(path, root), is_dir, is_dir and path not in parents) for path, is_dir in entries
+    )
+
+def _read_entry(entry: os.DirEntry) -> bytes:
+    """Reads a file's bytes in a single read sized by its (cached) stat."""
+    fd = os.open(entry.path, os.O_RDONLY)
+    try:
+        return os.read(fd, entry.stat().st_size)
+    finally:
+        os.close(fd)
+
+def _write_scrip(path: Path, *parts):
+    """Writes a scrip file from str (encoded as UTF-8) and bytes parts, in a single writev call."""
+    buffers = [part.encode('utf-8') if isinstance(part, str) else part for part in parts]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, buffers) if buffers else 0
+        else:  # Windows
+            written = os.write(fd, b"".join(buffers))
+        assert written == sum(map(len, buffers))
+    finally:
+        os.close(fd)
+
+def _make_scrip(entries) -> bytes:
+    """Builds scrip content the way flatten writes it.
+
+    entries are ("file", path, content) tuples for text files, with str or bytes
+    content, and ("empty", path) tuples for empty directories.
+    """
+    out = []
+    for kind, path, *rest in entries:
+        path = os.fsencode(path)
+        if kind == "file":
+            content = rest[0].encode('utf-8') if isinstance(rest[0], str) else rest[0]
+            if content.endswith(b"\n"):
+                out += (BFP_B, path, BFS_B, b"\n", content, EFP_B, path, TNM_B, EFS_B, b"\n")
+            else:
+                out += (BFP_B, path, BFS_B, b"\n", content, b"\n", EFP_B, path, EFS_B, b"\n")
+        else:
+            out += (EDP_B, path, EDS_B, b"\n")
+    return b"".join(out)
 
 def verify_restored_files(base_dir: Path, structure: dict):
-    """Recursively verifies files and directories match the expected structure."""
-    for name, content in structure.items():
-        path = base_dir / name
-        if isinstance(content, dict):
-            assert path.is_dir()
-            verify_restored_files(path, content)
-        elif isinstance(content, str):
-            assert path.is_file()
-            # With the new implementation, we preserve file content exactly
-            # without adding trailing newlines, so the comparison should be exact
-            assert path.read_text('utf-8') == content
-        elif content is None:
-            assert path.is_dir()
-            assert not any(path.iterdir()), f"Directory not empty: {path}"
+    """Verifies the files below base_dir are exactly those of the structure, byte for byte.
+
+    Directories expected to be empty must exist and have no entries.
+    """
+    dirs, files = _flatten_structure(base_dir, structure)
+    restored = {
+        entry.path: _read_entry(entry) for entry in _walk_tree(str(base_dir)) if not entry.is_dir(follow_symlinks=False)
+    }
+    assert restored == dict(files)
+    for dir_path, is_empty in dirs.items():
+        if is_empty:
+            assert_empty_dir(dir_path)
+
+def assert_empty_dir(path):
+    """Asserts a directory has no entries, reading at most one of them."""
+    with os.scandir(path) as it:
+        first = next(it, None)
+    assert first is None, f"Directory not empty: {path} ({first.name})"
 
 # --- Fixtures ---
 
-@pytest.fixture
-def source_dir(tmp_path):
-    """Provides the source directory path for tests."""
-    return tmp_path / "source"
+@pytest.fixture(scope="session")
+def templates(tmp_path_factory):
+    """Builds each of the shared STRUCTURES once per session; tests copy them as hardlinks."""
+    base = tmp_path_factory.mktemp("templates")
+    paths = {}
+    for name, structure in STRUCTURES.items():
+        paths[name] = base / name
+        paths[name].mkdir()
+        create_test_files(paths[name], structure)
+    return paths
 
-@pytest.fixture
-def scrip_file(tmp_path):
-    """Provides the path for the generated scrip file."""
-    return tmp_path / "output.scrip"
+Paths = namedtuple("Paths", "source scrip restore")
 
 @pytest.fixture
-def restore_dir(tmp_path):
-    """Provides the path for the restore output directory."""
-    return tmp_path / "restore_target"
+def paths(tmp_path):
+    """Provides the source directory, scrip file and restore directory paths for a test."""
+    return Paths(tmp_path / "source", tmp_path / "output.scrip", tmp_path / "restore_target")
 
 
-# --- Test Cases: Flattening (Text Only) ---
+# --- Test Cases: Flattening and Round Trips (Text Only) ---
 
-def test_flatten_empty_directory(source_dir, scrip_file):
+def test_flatten_empty_directory(paths):
     """Flatten an empty directory."""
+    paths.source.mkdir()
+    flatten_directory(str(paths.source), str(paths.scrip))
+    assert paths.scrip.read_bytes() == b""
+
+# Each shared structure with the scrip content it flattens to, in sorted path order
+ROUNDTRIP_CASES = [
+    ("single_text", _make_scrip([("file", "file1.txt", "Hello\nWorld")])),
+    ("multiple_text", _make_scrip([
+        ("file", "file1.txt", "Content 1"),
+        ("file", "file2.log", "Log line\nAnother log line"),
+    ])),
+    ("subdir_file", _make_scrip([("file", os.path.join("subdir", "nested.txt"), "Nested content.")])),
+    ("nested", _make_scrip([
+        ("file", os.path.join("a", "b", "file_b.txt"), "File in B."),
+        ("empty", os.path.join("a", "empty_b")),
+        ("file", os.path.join("a", "file_a.txt"), "File in A."),
+        ("empty", "empty_root"),
+        ("file", "file1.txt", "Root file."),
+    ])),
+]
+
+@pytest.mark.parametrize("name,expected", ROUNDTRIP_CASES, ids=[case[0] for case in ROUNDTRIP_CASES])
+def test_roundtrip(templates, paths, name, expected):
+    """Flatten a shared structure, check the exact scrip content, then restore it and check the tree."""
+    shutil.copytree(templates[name], paths.source, copy_function=os.link)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    assert paths.scrip.read_bytes() == expected
+    restore_directory(str(paths.scrip), str(paths.restore))
+    verify_restored_files(paths.restore, STRUCTURES[name])
+
+def test_flatten_only_leaf_empty_dirs_listed(paths):
+    """A directory holding only empty subdirectories is not itself listed as empty."""
+    structure = {"outer": {"inner": {"leaf": None}}}
+    paths.source.mkdir()
+    create_test_files(paths.source, structure)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    content = paths.scrip.read_bytes()
+    assert content == b"".join((EDP_B, os.fsencode(os.path.join('outer', 'inner', 'leaf')), EDS_B, b"\n"))
+
+def test_flatten_streamed_matches_parallel(tmp_path, monkeypatch):
+    """Files streamed on the main thread produce the same output as worker-read files."""
+    source_dir = tmp_path / "source"
     source_dir.mkdir()
-    core.flatten_directory(str(source_dir), str(scrip_file))
-    assert scrip_file.read_text('utf-8') == ""
-
-def test_flatten_single_text_file(source_dir, scrip_file):
-    """Flatten a directory with one text file."""
-    structure = {"file1.txt": "Hello\nWorld"}
-    source_dir.mkdir() # FIX: Create the source directory first
-    create_test_files(source_dir, structure)
-    core.flatten_directory(str(source_dir), str(scrip_file))
-    content = scrip_file.read_text('utf-8')
-    # FIX: Ensure expected content ends with newline
-    expected = (
-        f"{BFP}file1.txt{BFS}\n"
-        f"Hello\nWorld\n" # Content from structure, guaranteed newline by flatten
-        f"{EFP}file1.txt{EFS}\n"
-    )
-    assert content == expected
-
-def test_flatten_multiple_text_files(source_dir, scrip_file):
-    """Flatten a directory with multiple text files."""
-    structure = {
-        "file1.txt": "Content 1", # No trailing newline here
-        "file2.log": "Log line\nAnother log line" # Ends with newline
-    }
-    source_dir.mkdir() # FIX: Create the source directory first
-    create_test_files(source_dir, structure)
-    core.flatten_directory(str(source_dir), str(scrip_file))
-    content = scrip_file.read_text('utf-8')
-    # FIX: Ensure expected content ends with newline
-    expected = (
-        f"{BFP}file1.txt{BFS}\n"
-        f"Content 1\n" # Flatten adds newline
-        f"{EFP}file1.txt{EFS}\n"
-        f"{BFP}file2.log{BFS}\n"
-        f"Log line\nAnother log line\n" # Flatten keeps existing newline
-        f"{EFP}file2.log{EFS}\n"
-    )
-    assert content == expected
-
-def test_flatten_single_subdir_file(source_dir, scrip_file):
-    """Flatten a directory with one file in a subdirectory."""
-    structure = {"subdir": {"nested.txt": "Nested content."}}
-    source_dir.mkdir() # FIX: Create the source directory first
-    create_test_files(source_dir, structure)
-    core.flatten_directory(str(source_dir), str(scrip_file))
-    content = scrip_file.read_text('utf-8')
-    expected_path = Path("subdir") / "nested.txt"
-    # FIX: Ensure expected content ends with newline
-    expected = (
-        f"{BFP}{str(expected_path)}{BFS}\n"
-        f"Nested content.\n" # Flatten adds newline
-        f"{EFP}{str(expected_path)}{EFS}\n"
-    )
-    assert content == expected
-
-def test_flatten_nested_files_and_empty_dirs(source_dir, scrip_file):
-    """Flatten a directory with nested files and empty directories."""
-    structure = {
-        "file1.txt": "Root file.",
-        "a": {
-            "file_a.txt": "File in A.",
-            "b": {
-                "file_b.txt": "File in B."
-            },
-            "empty_b": None
-        },
-        "empty_root": None
-    }
-    source_dir.mkdir() # FIX: Create the source directory first
-    create_test_files(source_dir, structure)
-    core.flatten_directory(str(source_dir), str(scrip_file))
-    content = scrip_file.read_text('utf-8')
-
-    path_file1 = Path("file1.txt")
-    path_file_a = Path("a") / "file_a.txt"
-    path_file_b = Path("a") / "b" / "file_b.txt"
-    path_empty_b = Path("a") / "empty_b"
-    path_empty_root = Path("empty_root")
-
-    # FIX: Ensure expected content ends with newline and matches sorted path order
-    expected = (
-        f"{BFP}{str(path_file_b)}{BFS}\n" # a/b/file_b.txt
-        f"File in B.\n"
-        f"{EFP}{str(path_file_b)}{EFS}\n"
-        f"{EDP}{str(path_empty_b)}{EDS}\n" # a/empty_b
-        f"{BFP}{str(path_file_a)}{BFS}\n" # a/file_a.txt
-        f"File in A.\n"
-        f"{EFP}{str(path_file_a)}{EFS}\n"
-        f"{EDP}{str(path_empty_root)}{EDS}\n" # empty_root
-        f"{BFP}{str(path_file1)}{BFS}\n" # file1.txt
-        f"Root file.\n"
-        f"{EFP}{str(path_file1)}{EFS}\n"
-    )
-    assert content == expected
-
-def test_flatten_nonexistent_input(scrip_file):
+    create_test_files(source_dir, {"a.txt": "text", "sub": {"b.txt": "more\n"}, "empty": None})
+    (source_dir / "c.bin").write_bytes(os.urandom(100 * 1024) + b"\x00")
+    flatten_directory(str(source_dir), str(tmp_path / "parallel.scrip"))
+    monkeypatch.setattr(flattener, "PARALLEL_FILE_LIMIT", 0)
+    flatten_directory(str(source_dir), str(tmp_path / "streamed.scrip"))
+    assert (tmp_path / "parallel.scrip").read_bytes() == (tmp_path / "streamed.scrip").read_bytes()
+
+def test_flatten_bytes_in_flight_limit(tmp_path, monkeypatch):
+    """Output is unchanged when the byte budget allows only one file in flight at a time."""
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    create_test_files(source_dir, {f"file{i}.txt": f"Content {i}" for i in range(20)})
+    flatten_directory(str(source_dir), str(tmp_path / "windowed.scrip"))
+    monkeypatch.setattr(flattener, "MAX_BYTES_IN_FLIGHT", 0)
+    flatten_directory(str(source_dir), str(tmp_path / "one_at_a_time.scrip"))
+    assert (tmp_path / "windowed.scrip").read_bytes() == (tmp_path / "one_at_a_time.scrip").read_bytes()
+
+def test_flatten_file_deleted_mid_walk(paths, monkeypatch):
+    """A file that disappears after being listed gets an error entry; the flatten carries on."""
+    paths.source.mkdir()
+    create_test_files(paths.source, {"gone.txt": "soon deleted", "kept.txt": "kept"})
+    scandir = os.scandir
+
+    def scandir_then_delete(path):
+        with scandir(path) as it:
+            entries = list(it)
+        os.remove(os.path.join(paths.source, "gone.txt"))
+        return contextlib.nullcontext(entries)
+
+    monkeypatch.setattr(flattener.os, "scandir", scandir_then_delete)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    content = paths.scrip.read_bytes()
+    assert b"".join((BFP_B, b"gone.txt", BFS_B, b"\nError reading file content: ")) in content
+    assert _make_scrip([("file", "kept.txt", "kept")]) in content
+
+def test_flatten_nonexistent_input(paths):
     """Test flattening raises error for non-existent input directory."""
     with pytest.raises(ValueError, match="is not a valid directory"):
-        core.flatten_directory("non_existent_dir", str(scrip_file))
+        flatten_directory("non_existent_dir", str(paths.scrip))
 
-# --- Test Cases: Restoration (Text Only) ---
-
-def test_restore_empty_scrip(scrip_file, restore_dir):
-    """Restore from an empty scrip file (should create empty target dir)."""
-    scrip_file.write_text("", encoding='utf-8')
-    core.restore_directory(str(scrip_file), str(restore_dir))
-    assert restore_dir.is_dir()
-    assert not any(restore_dir.iterdir())
-
-def test_restore_single_text_file(scrip_file, restore_dir):
-    """Restore a single text file."""
-    # Note: Structure content doesn't need explicit trailing newline here,
-    # verify_restored_files handles the comparison correctly.
-    structure = {"file1.txt": "Hello\nWorld"}
-    scrip_content = (
-        f"{BFP}file1.txt{BFS}\n"
-        f"Hello\nWorld\n" # Content needs newline matching flatten's output
-        f"{EFP}file1.txt{EFS}\n"
-    )
-    scrip_file.write_text(scrip_content, encoding='utf-8')
-    core.restore_directory(str(scrip_file), str(restore_dir))
-    verify_restored_files(restore_dir, structure)
+# --- Test Cases: Parsing ---
 
-def test_restore_multiple_text_files(scrip_file, restore_dir):
-    """Restore multiple text files."""
-    structure = {
-        "file1.txt": "Content 1",
-        "file2.log": "Log line\nAnother log line"
-    }
-    scrip_content = (
-        f"{BFP}file1.txt{BFS}\n"
-        f"Content 1\n" # Needs newline matching flatten
-        f"{EFP}file1.txt{EFS}\n"
-        f"{BFP}file2.log{BFS}\n"
-        f"Log line\nAnother log line\n" # Needs newline matching flatten
-        f"{EFP}file2.log{EFS}\n"
-    )
-    scrip_file.write_text(scrip_content, encoding='utf-8')
-    core.restore_directory(str(scrip_file), str(restore_dir))
-    verify_restored_files(restore_dir, structure)
-
-def test_restore_single_subdir_file(scrip_file, restore_dir):
-    """Restore a single file in a subdirectory."""
-    structure = {"subdir": {"nested.txt": "Nested content."}}
-    nested_path = Path("subdir") / "nested.txt"
-    scrip_content = (
-        f"{BFP}{str(nested_path)}{BFS}\n"
-        f"Nested content.\n" # Needs newline matching flatten
-        f"{EFP}{str(nested_path)}{EFS}\n"
-    )
-    scrip_file.write_text(scrip_content, encoding='utf-8')
-    core.restore_directory(str(scrip_file), str(restore_dir))
-    verify_restored_files(restore_dir, structure)
+def test_parse_delimiter_line():
+    """Each delimiter kind is recognised in a single call; other lines are not."""
+    assert parser.parse_delimiter_line(f"{BFP}a b.txt{BFS}") == (parser.BEGIN_FILE_KIND, "a b.txt", False, False)
+    assert parser.parse_delimiter_line(f"{BFP}x.bin{BM}{BFS}") == (parser.BEGIN_FILE_KIND, "x.bin", True, False)
+    assert parser.parse_delimiter_line(f"{EFP}x.bin{BM}{EFS}") == (parser.END_FILE_KIND, "x.bin", True, False)
+    assert parser.parse_delimiter_line(f"{EFP}a.txt{TNM}{EFS}") == (parser.END_FILE_KIND, "a.txt", False, True)
+    assert parser.parse_delimiter_line(f"{EDP}a/b{EDS}") == (parser.EMPTY_DIR_KIND, "a/b", False, False)
+    assert parser.parse_delimiter_line(f"{BFP}unterminated") == (None, None, False, False)
+    assert parser.parse_delimiter_line("plain content") == (None, None, False, False)
 
-def test_restore_nested_files_and_empty_dirs(scrip_file, restore_dir):
-    """Restore nested files and empty directories."""
-    structure = {
-        "file1.txt": "Root file.",
-        "a": {
-            "file_a.txt": "File in A.",
-            "b": {
-                "file_b.txt": "File in B."
-            },
-            "empty_b": None
-        },
-        "empty_root": None
-    }
-    path_file1 = Path("file1.txt")
-    path_file_a = Path("a") / "file_a.txt"
-    path_file_b = Path("a") / "b" / "file_b.txt"
-    path_empty_b = Path("a") / "empty_b"
-    path_empty_root = Path("empty_root")
-    scrip_content = (
-        f"{BFP}{str(path_file_b)}{BFS}\n"
-        f"File in B.\n"
-        f"{EFP}{str(path_file_b)}{EFS}\n"
-        f"{EDP}{str(path_empty_b)}{EDS}\n"
-        f"{BFP}{str(path_file_a)}{BFS}\n"
-        f"File in A.\n"
-        f"{EFP}{str(path_file_a)}{EFS}\n"
-        f"{EDP}{str(path_empty_root)}{EDS}\n"
-        f"{BFP}{str(path_file1)}{BFS}\n"
-        f"Root file.\n"
-        f"{EFP}{str(path_file1)}{EFS}\n"
-    )
-    scrip_file.write_text(scrip_content, encoding='utf-8')
-    core.restore_directory(str(scrip_file), str(restore_dir))
-    verify_restored_files(restore_dir, structure)
+# --- Test Cases: Restoration (Text Only) ---
 
-def test_restore_nonexistent_input(restore_dir):
+def test_restore_empty_scrip(paths):
+    """Restore from an empty scrip file (should create empty target dir)."""
+    _write_scrip(paths.scrip)
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert_empty_dir(paths.restore)
+
+def test_restore_nested_empty_dirs_created_once(paths, monkeypatch):
+    """The deepest listed empty directory is created first, bringing its listed ancestors with it."""
+    calls = []
+    depth = 0  # os.makedirs calls itself for missing parents; only the restorer's own calls count
+    makedirs = os.makedirs
+
+    def record_makedirs(path, **kwargs):
+        nonlocal depth
+        if not depth:
+            calls.append(path)
+        depth += 1
+        try:
+            return makedirs(path, **kwargs)
+        finally:
+            depth -= 1
+
+    monkeypatch.setattr(restorer.os, "makedirs", record_makedirs)
+    a, a_b, a_b_c = "a", os.path.join("a", "b"), os.path.join("a", "b", "c")
+    _write_scrip(paths.scrip, _make_scrip([("empty", path) for path in (a, a_b, a_b_c, a_b)]))
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert _collect_files(str(paths.restore)) == [(a, True, False), (a_b, True, False), (a_b_c, True, True)]
+    assert calls == [str(paths.restore), os.path.join(str(paths.restore), a_b_c)]
+
+def test_restore_many_files_in_parallel(paths):
+    """Files written by worker threads all complete, and a path listed twice keeps its last entry."""
+    structure = {f"file{i}.txt": f"Content {i}" for i in range(100)}
+    entries = [("file", name, text) for name, text in structure.items()]
+    entries.append(("file", "file0.txt", "Replaced"))
+    structure["file0.txt"] = "Replaced"
+    _write_scrip(paths.scrip, _make_scrip(entries))
+    core.ScripRestorer(max_workers=4).restore(str(paths.scrip), str(paths.restore))
+    verify_restored_files(paths.restore, structure)
+
+def test_restore_content_resembling_delimiters(paths):
+    """Content lines sharing the delimiter prefix are kept as content."""
+    body = "--- not a delimiter ---\n--- BEGIN FILE: half\n--- EMPTY\nend"
+    structure = {"notes.md": body}
+    _write_scrip(paths.scrip, _make_scrip([("file", "notes.md", body)]))
+    restore_directory(str(paths.scrip), str(paths.restore))
+    verify_restored_files(paths.restore, structure)
+
+def test_restore_nonexistent_input(paths):
     """Test restoration raises error for non-existent input file."""
     with pytest.raises(ValueError, match="is not a valid file"):
-        core.restore_directory("non_existent.scrip", str(restore_dir))
+        restore_directory("non_existent.scrip", str(paths.restore))
 
-def test_restore_conflict_error(scrip_file, restore_dir):
+def test_restore_into_existing_directory(paths):
+    """Restoring next to unrelated existing files succeeds and leaves them alone."""
+    _write_scrip(paths.scrip, _make_scrip([("file", "new.txt", "New")]))
+    paths.restore.mkdir()
+    (paths.restore / "other.txt").write_bytes(b"untouched")
+    restore_directory(str(paths.scrip), str(paths.restore))
+    verify_restored_files(paths.restore, {"new.txt": "New", "other.txt": "untouched"})
+
+def test_restore_conflict_error(paths):
     """Test restoration raises FileExistsError if text file conflicts exist."""
     # Define structure and create scrip file
     structure = {"file1.txt": "Content"}
-    scrip_content = f"{BFP}file1.txt{BFS}\nContent\n{EFP}file1.txt{EFS}\n"
-    scrip_file.write_text(scrip_content, encoding='utf-8')
+    _write_scrip(paths.scrip, _make_scrip([("file", "file1.txt", "Content")]))
 
     # Create conflicting file
-    restore_dir.mkdir()
-    (restore_dir / "file1.txt").write_text("pre-existing")
+    paths.restore.mkdir()
+    (paths.restore / "file1.txt").write_bytes(b"pre-existing")
 
-    with pytest.raises(FileExistsError, match="already exist"):
-        core.restore_directory(str(scrip_file), str(restore_dir))
+    with pytest.raises(FileExistsError) as excinfo:
+        restore_directory(str(paths.scrip), str(paths.restore))
+    assert _CONFLICT_RE.search(str(excinfo.value))
     # Verify pre-existing file was not touched
-    assert (restore_dir / "file1.txt").read_text() == "pre-existing"
+    assert (paths.restore / "file1.txt").read_bytes() == b"pre-existing"
+
+def test_restore_conflict_error_binary_file(paths):
+    """Conflicts are detected for binary entries, reported without the binary marker."""
+    scrip_content = f"{BFP}blob.bin{BM}{BFS}\nAAEC\n{EFP}blob.bin{BM}{EFS}\n"
+    _write_scrip(paths.scrip, scrip_content)
+    paths.restore.mkdir()
+    (paths.restore / "blob.bin").write_bytes(b"pre-existing")
+
+    with pytest.raises(FileExistsError, match="blob.bin$"):
+        restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "blob.bin").read_bytes() == b"pre-existing"
+
+def test_restore_conflict_in_missing_parent(paths):
+    """Entries whose parent directory does not exist yet are not conflicts."""
+    _write_scrip(paths.scrip, _make_scrip([
+        ("file", os.path.join("new", "file.txt"), "New"),
+        ("file", "file.txt", "Old"),
+    ]))
+    paths.restore.mkdir()
+    (paths.restore / "file.txt").write_bytes(b"pre-existing")
 
-def test_restore_conflict_error_message(scrip_file, restore_dir):
+    with pytest.raises(FileExistsError) as excinfo:
+        restore_directory(str(paths.scrip), str(paths.restore))
+    assert str(excinfo.value).endswith("\nfile.txt")
+
+def test_restore_conflict_error_message(paths):
     """Test the conflict error message lists the correct conflicting text files."""
     structure = {
         "file1.txt": "",
         "a": {"b": {"file2.txt": ""}}, # Nested conflict
         "a": {"c": None} # Empty dir conflict
     }
-    path1 = Path("file1.txt")
-    path2 = Path("a") / "b" / "file2.txt"
-    path3 = Path("a") / "c"
-    scrip_content = (
-        f"{BFP}{str(path1)}{BFS}\n\n{EFP}{str(path1)}{EFS}\n"
-        f"{BFP}{str(path2)}{BFS}\n\n{EFP}{str(path2)}{EFS}\n"
-        f"{EDP}{str(path3)}{EDS}\n"
-    )
-    scrip_file.write_text(scrip_content, encoding='utf-8')
+    path1 = "file1.txt"
+    path2 = os.path.join("a", "b", "file2.txt")
+    path3 = os.path.join("a", "c")
+    _write_scrip(paths.scrip, _make_scrip([("file", path1, ""), ("file", path2, ""), ("empty", path3)]))
 
     # Create conflicts
-    restore_dir.mkdir()
-    (restore_dir / path1).touch()
-    (restore_dir / path2).parent.mkdir(parents=True, exist_ok=True)
-    (restore_dir / path2).touch()
-    (restore_dir / path3).mkdir(parents=True, exist_ok=True)
+    os.makedirs(os.path.join(paths.restore, "a", "b"))
+    os.mkdir(os.path.join(paths.restore, path3))
+    for path in (path1, path2):
+        os.close(os.open(os.path.join(paths.restore, path), os.O_WRONLY | os.O_CREAT, 0o644))
 
     with pytest.raises(FileExistsError) as excinfo:
-        core.restore_directory(str(scrip_file), str(restore_dir))
+        restore_directory(str(paths.scrip), str(paths.restore))
 
     error_msg = str(excinfo.value)
     print(f"Conflict Error: {error_msg}") # Print for debugging
-    assert str(path1) in error_msg
-    assert str(path2) in error_msg
-    assert str(path3) in error_msg
+    assert _CONFLICT_RE.search(error_msg)
+    assert path1 in error_msg
+    assert path2 in error_msg
+    assert path3 in error_msg
+
+def test_flatten_and_restore_non_utf8_text(paths):
+    """Text files that are not valid UTF-8 are restored byte for byte."""
+    data = "caf\u00e9 latin-1".encode('latin-1')
+    paths.source.mkdir()
+    (paths.source / "legacy.txt").write_bytes(data)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    assert data in paths.scrip.read_bytes()
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "legacy.txt").read_bytes() == data
+
+def test_flatten_and_restore_crlf_text(paths):
+    """Line endings inside text files are restored byte for byte."""
+    data = b"first\r\nsecond\r\nlast"
+    paths.source.mkdir()
+    (paths.source / "dos.txt").write_bytes(data)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "dos.txt").read_bytes() == data
+
+def test_flatten_and_restore_trailing_newlines(paths):
+    """Whether a text file ends in a newline is recorded on its END marker and restored exactly."""
+    structure = {"none.txt": "no newline", "one.txt": "one\n", "two.txt": "two\n\n", "only.txt": "\n"}
+    paths.source.mkdir()
+    create_test_files(paths.source, structure)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    content = paths.scrip.read_bytes()
+    assert b"".join((b"no newline\n", EFP_B, b"none.txt", EFS_B, b"\n")) in content
+    assert b"".join((b"one\n", EFP_B, b"one.txt", TNM_B, EFS_B, b"\n")) in content
+    restore_directory(str(paths.scrip), str(paths.restore))
+    for name, text in structure.items():
+        assert (paths.restore / name).read_bytes() == text.encode('utf-8')
+
+def test_restore_legacy_entries_without_newline_marker(paths, monkeypatch):
+    """Entries flattened before the END marker recorded final newlines restore as they always did.
+
+    Content ending in a blank line keeps its final newline; otherwise the newline
+    added by the flattener is dropped. Flushing a large file partway through
+    must not change that.
+    """
+    monkeypatch.setattr(restorer, "FLUSH_THRESHOLD", 16)
+    long_text = "".join(f"line {i}\n" for i in range(50))
+    entries = {"two.txt": "two\n\n", "none.txt": "no newline\n", "long.txt": long_text + "\n"}
+    _write_scrip(paths.scrip, *(f"{BFP}{name}{BFS}\n{text}{EFP}{name}{EFS}\n" for name, text in entries.items()))
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "two.txt").read_bytes() == b"two\n\n"
+    assert (paths.restore / "none.txt").read_bytes() == b"no newline"
+    assert (paths.restore / "long.txt").read_bytes() == (long_text + "\n").encode('utf-8')
+
+def test_flatten_and_restore_name_ending_in_newline_marker(paths, capsys):
+    """A file name ending in the newline marker text is not mistaken for the marker."""
+    structure = {f"plain{TNM}": "no newline", f"newline{TNM}": "newline\n"}
+    paths.source.mkdir()
+    create_test_files(paths.source, structure)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    restore_directory(str(paths.scrip), str(paths.restore))
+    verify_restored_files(paths.restore, structure)
+    assert "Warning" not in capsys.readouterr().out
+
+# --- Test Cases: Binary Files ---
+
+def test_is_binary_detection(tmp_path):
+    """Files with null bytes or many control bytes (as in random data) are binary; ordinary text is not."""
+    text = tmp_path / "text.txt"
+    text.write_bytes("caf\u00e9\ttab\r\n\x1b[1mbold\x1b[0m\n".encode('utf-8') * 50)
+    with_null = tmp_path / "null.bin"
+    with_null.write_bytes(b"text" * 100 + b"\x00")
+    control_heavy = tmp_path / "control.bin"
+    control_heavy.write_bytes(bytes(range(1, 32)) * 20)
+    random_no_null = tmp_path / "random.bin"
+    random_no_null.write_bytes(os.urandom(8192).replace(b"\x00", b"")[:4096])
+    assert not core.is_binary(text)
+    assert core.is_binary(with_null)
+    assert core.is_binary(control_heavy)
+    assert core.is_binary(random_no_null)
+
+def test_flatten_and_restore_binary_file(paths):
+    """Binary files are base64 encoded on flatten and decoded on restore."""
+    data = bytes(range(256)) * 4
+    paths.source.mkdir()
+    (paths.source / "blob.bin").write_bytes(data)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    content = paths.scrip.read_bytes()
+    expected = b"".join((
+        BFP_B, b"blob.bin", BM_B, BFS_B, b"\n",
+        base64.b64encode(data), b"\n",
+        EFP_B, b"blob.bin", BM_B, EFS_B, b"\n",
+    ))
+    assert content == expected
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "blob.bin").read_bytes() == data
+
+def test_flatten_large_binary_file_single_line(paths, monkeypatch):
+    """Binary files larger than one read chunk are still written as one base64 line."""
+    monkeypatch.setattr(flattener, "PARALLEL_FILE_LIMIT", 0)  # Force the streaming path
+    monkeypatch.setattr(flattener, "BINARY_CHUNK_SIZE", 3 * 1024)
+    data = os.urandom(200 * 1024) + b'\x00'
+    paths.source.mkdir()
+    (paths.source / "big.bin").write_bytes(data)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    lines = paths.scrip.read_bytes().splitlines()
+    assert lines[1] == base64.b64encode(data)
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "big.bin").read_bytes() == data
+
+def test_restore_multiline_base64(paths):
+    """Restore accepts base64 content wrapped across several lines."""
+    data = bytes(range(256))
+    encoded = base64.encodebytes(data)  # Wrapped at 76 chars
+    _write_scrip(paths.scrip, f"{BFP}blob.bin{BM}{BFS}\n", encoded, f"{EFP}blob.bin{BM}{EFS}\n")
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "blob.bin").read_bytes() == data
+
+@pytest.mark.parametrize("backend", ["stdlib", "pybase64"])
+def test_restore_base64_with_trailing_whitespace(paths, monkeypatch, capsys, backend):
+    """Wrapped base64 with whitespace at the line ends decodes the same with either decoder backend."""
+    if backend == "pybase64":
+        pytest.importorskip("pybase64")  # With the fast extra installed, file_utils decodes with it
+    else:
+        monkeypatch.setattr(restorer, "b64decode_line", binascii.a2b_base64)
+    monkeypatch.setattr(restorer, "BINARY_DECODE_CHUNK", 100)  # Slices split lines mid-way
+    data = os.urandom(1000)
+    padded = base64.encodebytes(data).replace(b"\n", b" \t\n")
+    _write_scrip(paths.scrip, f"{BFP}blob.bin{BM}{BFS}\n", padded, f"{EFP}blob.bin{BM}{EFS}\n")
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "blob.bin").read_bytes() == data
+    assert "Warning" not in capsys.readouterr().out
+
+def test_restore_flushes_large_files_in_parts(paths, monkeypatch):
+    """Content is written out in parts once the buffer threshold is crossed."""
+    monkeypatch.setattr(restorer, "FLUSH_THRESHOLD", 16)
+    text = b"".join(b"line %d\n" % i for i in range(50)) + b"\n"
+    data = os.urandom(1000)
+    encoded = base64.encodebytes(data)
+    _write_scrip(
+        paths.scrip,
+        f"{BFP}notes.txt{BFS}\n", text, f"{EFP}notes.txt{TNM}{EFS}\n",
+        f"{BFP}blob.bin{BM}{BFS}\n", encoded, f"{EFP}blob.bin{BM}{EFS}\n",
+    )
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "notes.txt").read_bytes() == text
+    assert (paths.restore / "blob.bin").read_bytes() == data
+
+def test_restore_streams_binary_in_slices(paths, monkeypatch):
+    """Base64 is decoded in bounded slices, however the lines are wrapped."""
+    monkeypatch.setattr(restorer, "BINARY_DECODE_CHUNK", 8)
+    data = os.urandom(999)
+    encoded = base64.b64encode(data)
+    wrapped = b"".join(encoded[i:i + 5] + b"\n" for i in range(0, len(encoded), 5))
+    _write_scrip(
+        paths.scrip,
+        f"{BFP}single.bin{BM}{BFS}\n", encoded, f"\n{EFP}single.bin{BM}{EFS}\n",
+        f"{BFP}wrapped.bin{BM}{BFS}\n", wrapped, f"{EFP}wrapped.bin{BM}{EFS}\n",
+    )
+    restore_directory(str(paths.scrip), str(paths.restore))
+    assert (paths.restore / "single.bin").read_bytes() == data
+    assert (paths.restore / "wrapped.bin").read_bytes() == data
+
+def test_restore_binary_with_direct_io(tmp_path, paths, monkeypatch):
+    """Binary files written with direct I/O are trimmed back to their exact size."""
+    try:
+        file_utils.DirectFileWriter(str(tmp_path / "probe")).close()
+    except OSError:
+        pytest.skip("O_DIRECT is not supported by this platform or file system")
+    opened = []  # Restore falls back to buffered writes silently, so check it really used O_DIRECT
+    monkeypatch.setattr(
+        restorer, "DirectFileWriter", lambda path: opened.append(path) or file_utils.DirectFileWriter(path)
+    )
+    monkeypatch.setattr(restorer, "DIRECT_IO_MIN_SIZE", 0)
+    structure = {"big.bin": os.urandom((2 << 20) + 1234) + b'\x00', "small.bin": b'\x00\x01'}
+    paths.source.mkdir()
+    create_test_files(paths.source, structure)
+    flatten_directory(str(paths.source), str(paths.scrip))
+    core.ScripRestorer(direct_io=True).restore(str(paths.scrip), str(paths.restore))
+    assert sorted(opened) == [os.path.join(str(paths.restore), name) for name in sorted(structure)]
+    for name, data in structure.items():
+        assert (paths.restore / name).read_bytes() == data
+
+def test_direct_file_writer_short_write(tmp_path, monkeypatch):
+    """A short O_DIRECT write raises instead of retrying from an unaligned offset."""
+    try:
+        writer = file_utils.DirectFileWriter(str(tmp_path / "out.bin"))
+    except OSError:
+        pytest.skip("O_DIRECT is not supported by this platform or file system")
+    monkeypatch.setattr(file_utils.os, "write", lambda fd, data: len(data) // 2)
+    writer.write(b"x" * 100)
+    with pytest.raises(OSError, match="Short write"):
+        writer.close()
 
 # TODO:
-# - Add back binary file tests later.
 # - Add tests for file content exactly matching (e.g., handling of final newlines).
 # - Add tests for files/dirs with unusual names.
 # - Add tests for large files.
@@ -325,4 +633,4 @@ def test_restore_conflict_error_message(scrip_file, restore_dir):
 # - Files/dirs with unusual names (spaces, symbols)? (Pathlib should handle)
 # - Very large files?
 # - Corrupted scrip file (missing delimiters, bad base64)?
-# - Handling of file permissions? (Not currently preserved) 
\ No newline at end of file
+# - Handling of file permissions? (Not currently preserved)